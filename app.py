@@ -4,17 +4,37 @@
 
 import os
 import json
+import mimetypes
+import copy
+import mmap
 import uuid
+import threading
 import traceback
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 from flask import (
     Flask, render_template, request, jsonify,
     send_from_directory, make_response, redirect,
-    url_for, session
+    url_for, session, stream_with_context, abort
 )
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from urllib.parse import quote
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-from predictor import detect_phishing, retrain_model, train_from_csv
+from predictor import detect_phishing, detect_phishing_batch, retrain_model, train_from_csv
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # POSIX only; lets gunicorn workers share the history log safely
+except ImportError:
+    fcntl = None
 
 # ============================================================
 # App Configuration
@@ -24,14 +44,29 @@ APP.secret_key = "phisguard_secret_key"
 
 APP.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max upload
 
+# Response cache for read-only GET endpoints. Keys embed the backing
+# file's stamp, so a write from any worker invalidates them implicitly.
+cache = Cache(APP, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 5})
+
 DATA_DIR = "data"
 UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
-HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+SETTINGS_LOCK_FILE = SETTINGS_FILE + ".lock"
+HISTORY_FILE = os.path.join(DATA_DIR, "history.jsonl")
+LEGACY_HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+HISTORY_LOCK_FILE = HISTORY_FILE + ".lock"
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Hand upload downloads to the front-end server so it streams them with
+# sendfile(2) instead of tying up a worker. For nginx, set the prefix of an
+# `internal` location that aliases UPLOAD_DIR, e.g.
+#   location /protected_uploads/ { internal; alias /srv/phisguard/data/uploads/; }
+# For Apache mod_xsendfile set PHISGUARD_X_SENDFILE=1. Unset, Flask serves them.
+UPLOADS_ACCEL_PREFIX = os.environ.get("PHISGUARD_UPLOADS_ACCEL", "").rstrip("/")
+APP.use_x_sendfile = os.environ.get("PHISGUARD_X_SENDFILE") == "1"
+
 DEFAULT_SETTINGS = {
     "threshold": 0.6,
     "ml_weight": 0.85,
@@ -42,38 +77,283 @@ DEFAULT_SETTINGS = {
 }
 
 HISTORY_LIMIT = 1000
+HISTORY_HIGH_WATER = 2 * HISTORY_LIMIT  # compact the log once it holds this many lines
+HISTORY_MMAP_MIN_BYTES = 4096  # below one page a plain read() is cheaper than mmap
 
 # ============================================================
 # JSON Utilities
 # ============================================================
+def json_dumps(data, pretty=False):
+    """Serialize to UTF-8 bytes; orjson when available, compact unless pretty."""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if pretty:
+            option |= orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+        return orjson.dumps(data, option=option)
+    if pretty:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8") + b"\n"
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def json_loads(raw):
+    """Parse str, bytes or a memoryview (e.g. a slice of an mmap)."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(bytes(raw) if isinstance(raw, memoryview) else raw)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson (numpy-aware, unsorted, compact)."""
+    sort_keys = False
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # build the body straight from orjson's bytes, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+if orjson is not None:
+    APP.json = OrjsonProvider(APP)
+
 def load_json(path, default):
-    if not os.path.exists(path):
+    try:
+        # one read() of the whole file, parsed straight from bytes
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
         save_json(path, default)
         return default
+    except OSError:
+        return default
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
+        return json_loads(raw) if raw else default
+    except ValueError:
         return default
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    # write to a sibling temp file, then atomically swap it in
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(json_dumps(data, pretty=True))
+    os.replace(tmp, path)
 
-def get_settings():
-    """Ensure all default keys exist."""
-    data = load_json(SETTINGS_FILE, DEFAULT_SETTINGS.copy())
-    for key, value in DEFAULT_SETTINGS.items():
-        if key not in data:
-            data[key] = value
-    return data
+_SETTINGS_CACHE = {"stamp": None, "data": None}
+_SETTINGS_LOCK = threading.RLock()
+
+def settings_stamp():
+    """(mtime_ns, size) of the settings file, or None if it does not exist yet."""
+    try:
+        st = os.stat(SETTINGS_FILE)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def get_settings(readonly=False):
+    """
+    Ensure all default keys exist. Re-parsed only when the file changes on disk.
+    readonly=True returns the shared cached dict without copying; callers must not mutate it.
+    """
+    with _SETTINGS_LOCK:
+        stamp = settings_stamp()
+        if stamp is None or stamp != _SETTINGS_CACHE["stamp"] or _SETTINGS_CACHE["data"] is None:
+            data = load_json(SETTINGS_FILE, DEFAULT_SETTINGS.copy())
+            for key, value in DEFAULT_SETTINGS.items():
+                if key not in data:
+                    data[key] = value
+            _SETTINGS_CACHE["data"] = data
+            _SETTINGS_CACHE["stamp"] = stamp
+        if readonly:
+            return _SETTINGS_CACHE["data"]
+        # callers mutate the result before saving, so never hand out the cached dict
+        return copy.deepcopy(_SETTINGS_CACHE["data"])
+
+@contextmanager
+def _flocked(path):
+    """Exclusive flock on path so worker processes take turns, where flock exists."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+@contextmanager
+def _settings_locked():
+    """Hold for a settings read-modify-write, across threads and worker processes."""
+    with _SETTINGS_LOCK, _flocked(SETTINGS_LOCK_FILE):
+        yield
 
 def save_settings(data):
     data["last_updated"] = datetime.utcnow().isoformat()
-    save_json(SETTINGS_FILE, data)
+    with _SETTINGS_LOCK:
+        save_json(SETTINGS_FILE, data)
+        _SETTINGS_CACHE["stamp"] = None
 
-if not os.path.exists(HISTORY_FILE):
-    save_json(HISTORY_FILE, [])
+# ============================================================
+# Scan History (append-only JSONL + in-memory cache)
+# ============================================================
+_HIST_CACHE = None  # deque, newest first, loaded lazily
+_HIST_LINES = 0     # records currently stored in HISTORY_FILE
+_HIST_STAMP = None  # (generation, st_ino, st_size) of HISTORY_FILE as last seen by this process
+_HIST_LOCK = threading.Lock()
+
+@contextmanager
+def _history_locked():
+    """Serialize history access across threads, and across worker processes where flock exists."""
+    with _HIST_LOCK, _flocked(HISTORY_LOCK_FILE):
+        yield
+
+def _history_generation():
+    """Rewrite counter kept in the lock file; inode numbers alone get reused across os.replace."""
+    try:
+        with open(HISTORY_LOCK_FILE, "rb") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def _bump_history_generation():
+    """Caller holds the history lock. Written in place: replacing the file would orphan the flock."""
+    gen = _history_generation() + 1
+    with open(HISTORY_LOCK_FILE, "r+b" if os.path.exists(HISTORY_LOCK_FILE) else "wb") as f:
+        f.write(str(gen).encode())
+        f.truncate()
+    return gen
+
+def _history_stamp():
+    try:
+        st = os.stat(HISTORY_FILE)
+    except FileNotFoundError:
+        return None
+    return _history_generation(), st.st_ino, st.st_size
+
+def _ends_line_at(offset):
+    """True if the log has a record boundary right before offset."""
+    if offset == 0:
+        return True
+    with open(HISTORY_FILE, "rb") as f:
+        f.seek(offset - 1)
+        return f.read(1) == b"\n"
+
+def _read_history_locked(offset=0):
+    """Push log records from byte offset onward into the cache. Caller holds the history lock."""
+    global _HIST_LINES
+    with open(HISTORY_FILE, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size - offset < HISTORY_MMAP_MIN_BYTES:
+            f.seek(offset)
+            buf, start = f.read(), 0
+        else:
+            # map the log instead of copying it; lines are parsed in place from the page cache
+            buf, start = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), offset
+    try:
+        # Walk lines newest first and stop parsing once HISTORY_LIMIT records
+        # are in hand; anything older would be evicted from the cache anyway.
+        newest = []
+        with memoryview(buf) as view:
+            pos = len(buf)
+            while pos > start:
+                nl = buf.rfind(b"\n", start, pos)
+                lo, hi, pos = max(nl + 1, start), pos, max(nl, start)
+                if not buf[lo:lo + 1].strip():
+                    continue  # blank line
+                _HIST_LINES += 1
+                if len(newest) < HISTORY_LIMIT:
+                    with view[lo:hi] as line:
+                        try:
+                            newest.append(json_loads(line))
+                        except ValueError:
+                            continue
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    _HIST_CACHE.extendleft(reversed(newest))
+
+def _rewrite_history_locked():
+    """Atomically rewrite the log from the cache (oldest first). Caller holds the history lock."""
+    global _HIST_LINES, _HIST_STAMP
+    tmp = f"{HISTORY_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(json_dumps(r) + b"\n" for r in reversed(_HIST_CACHE)))
+    os.replace(tmp, HISTORY_FILE)
+    _bump_history_generation()
+    _HIST_LINES = len(_HIST_CACHE)
+    _HIST_STAMP = _history_stamp()
+
+def _load_history_locked():
+    """Sync the cache with the log, reading only what other processes appended. Caller holds the history lock."""
+    global _HIST_CACHE, _HIST_LINES, _HIST_STAMP
+    stamp = _history_stamp()
+    if _HIST_CACHE is not None and stamp == _HIST_STAMP:
+        return _HIST_CACHE
+    if stamp is None:
+        # One-time migration from the legacy newest-first JSON array
+        records = []
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            records = load_json(LEGACY_HISTORY_FILE, [])
+        if not isinstance(records, list):
+            records = []
+        _HIST_CACHE = deque(records[:HISTORY_LIMIT], maxlen=HISTORY_LIMIT)
+        _rewrite_history_locked()
+        return _HIST_CACHE
+    if (_HIST_CACHE is not None and _HIST_STAMP and stamp[:2] == _HIST_STAMP[:2]
+            and stamp[2] > _HIST_STAMP[2] and _ends_line_at(_HIST_STAMP[2])):
+        # same file and generation, only grown: another worker appended
+        _read_history_locked(_HIST_STAMP[2])
+    else:
+        _HIST_CACHE = deque(maxlen=HISTORY_LIMIT)
+        _HIST_LINES = 0
+        _read_history_locked()
+    _HIST_STAMP = stamp
+    return _HIST_CACHE
+
+def history_stamp():
+    """Version of the history log after syncing this process's cache with it."""
+    with _history_locked():
+        _load_history_locked()
+        return _HIST_STAMP
+
+def get_history(match=None):
+    """Return cached history newest first, optionally filtered by match(record) in the same pass."""
+    with _history_locked():
+        hist = _load_history_locked()
+        if match is None:
+            return list(hist)
+        return [h for h in hist if match(h)]
+
+def append_history(records):
+    """Record new scan results: O(1) append to the log instead of a full rewrite."""
+    global _HIST_LINES, _HIST_STAMP
+    with _history_locked():
+        hist = _load_history_locked()
+        # Raw O_APPEND fd: one write() for the whole batch, no buffered file object
+        data = memoryview(b"".join(json_dumps(r) + b"\n" for r in records))
+        fd = os.open(HISTORY_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        for r in records:
+            hist.appendleft(r)  # O(1); maxlen evicts the oldest
+        _HIST_LINES += len(records)
+        _HIST_STAMP = _HIST_STAMP[0], st.st_ino, st.st_size
+        if _HIST_LINES > HISTORY_HIGH_WATER:
+            _rewrite_history_locked()
+
+def clear_history():
+    global _HIST_CACHE
+    with _history_locked():
+        _HIST_CACHE = deque(maxlen=HISTORY_LIMIT)
+        _rewrite_history_locked()
 
 # ============================================================
 # Authentication Decorator
@@ -101,70 +381,99 @@ def ensure_visitor(resp):
 # ============================================================
 @APP.route("/")
 def index():
-    settings = get_settings()
+    settings = get_settings(readonly=True)
     resp = make_response(render_template("scanner.html", settings=settings, current_year=datetime.utcnow().year))
     return ensure_visitor(resp)
 
+def _collect_scan_inputs():
+    """Return (text, extra_fields) pairs for the file and/or URL in the scan form."""
+    url_text = (request.form.get("url") or request.form.get("input_text") or "").strip()
+    file = request.files.get("file")
+    items = []
+
+    if file and file.filename:
+        filename = secure_filename(file.filename)
+        path = os.path.join(UPLOAD_DIR, filename)
+        file.save(path)
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+        except Exception:
+            content = None
+        items.append((content or path, {"type": "file", "uploaded_file": filename}))
+
+    if url_text:
+        items.append((url_text, {"type": "url", "uploaded_file": None}))
+    return items
+
+def _annotate(r, extra, visitor_id):
+    r.update(extra)
+    r.update({
+        "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "user_id": visitor_id
+    })
+    return r
+
+def _scan_item(text, extra, settings, visitor_id):
+    return _annotate(detect_phishing(text, settings), extra, visitor_id)
+
 @APP.route("/scan", methods=["POST"])
 def scan():
     try:
         visitor_id = request.cookies.get("visitor_id") or uuid.uuid4().hex[:16]
-        settings = get_settings()
-        url_text = (request.form.get("url") or request.form.get("input_text") or "").strip()
-        file = request.files.get("file")
-        results = []
-
-        if file and file.filename:
-            filename = secure_filename(file.filename)
-            path = os.path.join(UPLOAD_DIR, filename)
-            file.save(path)
-            try:
-                with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-            except Exception:
-                content = None
-            r = detect_phishing(content or path, settings)
-            r.update({"type": "file", "uploaded_file": filename})
-            results.append(r)
-
-        if url_text:
-            r = detect_phishing(url_text, settings)
-            r.update({"type": "url", "uploaded_file": None})
-            results.append(r)
-
-        if not results:
+        settings = get_settings(readonly=True)
+        items = _collect_scan_inputs()
+
+        if not items:
             return jsonify({"error": "No URL or file provided"}), 400
 
-        # Save history
-        hist = load_json(HISTORY_FILE, [])
-        for r in results:
-            r.update({
-                "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                "user_id": visitor_id,
-                "ml_probability": float(r.get("ml_probability", 0.0)),
-                "heuristic_score": float(r.get("heuristic_score", 0.0)),
-                "final_score": float(r.get("final_score", 0.0))
-            })
-            hist.insert(0, r)
-        hist = hist[:HISTORY_LIMIT]
-        save_json(HISTORY_FILE, hist)
+        # Clients that ask for NDJSON get each result as soon as it is scored
+        wanted = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+        if wanted == "application/x-ndjson":
+            def generate():
+                for text, extra in items:
+                    try:
+                        r = _scan_item(text, extra, settings, visitor_id)
+                    except Exception as e:
+                        traceback.print_exc()
+                        yield json_dumps({"error": "Internal server error", "detail": str(e)}) + b"\n"
+                        continue
+                    append_history([r])
+                    yield json_dumps(r) + b"\n"
+            return APP.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        # File and URL together go through one feature pass and one model call
+        scored = detect_phishing_batch([text for text, _ in items], settings)
+        results = [_annotate(r, extra, visitor_id) for r, (_, extra) in zip(scored, items)]
+        append_history(results)
 
         return jsonify(results[0] if len(results) == 1 else results)
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": "Internal server error", "detail": str(e)}), 500
 
+def _history_cache_key():
+    return f"history:{request.cookies.get('visitor_id')}:{request.query_string.decode()}:{history_stamp()}"
+
 @APP.route("/history")
+@cache.cached(timeout=2, make_cache_key=_history_cache_key)
 def history():
     visitor_id = request.cookies.get("visitor_id")
-    hist = load_json(HISTORY_FILE, [])
-    own = [h for h in hist if h.get("user_id") == visitor_id] if visitor_id else []
+    # filtered in the same pass that copies records out of the cache
+    own = get_history(lambda h: h.get("user_id") == visitor_id) if visitor_id else []
     if request.args.get("json") == "1":
         return jsonify(own)
     return render_template("history.html", history=own, current_year=datetime.utcnow().year)
 
 @APP.route("/uploads/<path:filename>")
 def uploaded_file(filename):
+    if UPLOADS_ACCEL_PREFIX:
+        if safe_join(UPLOAD_DIR, filename) is None:
+            abort(404)
+        resp = make_response("")
+        resp.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        resp.headers["X-Accel-Redirect"] = f"{UPLOADS_ACCEL_PREFIX}/{quote(filename)}"
+        return resp
     return send_from_directory(UPLOAD_DIR, filename, as_attachment=False)
 
 @APP.route("/_health")
@@ -181,7 +490,7 @@ def admin_login():
     error = ""
     if request.method == "POST":
         entered = request.form.get("password","")
-        settings = get_settings()
+        settings = get_settings(readonly=True)
         if entered == settings.get("admin_pass","admin123"):
             session["admin_logged_in"] = True
             return redirect(f"{ADMIN_ROUTE}/dashboard")
@@ -204,16 +513,18 @@ def admin_dashboard():
 # ============================================================
 @APP.route(f"{ADMIN_ROUTE}/api/settings", methods=["GET"])
 @login_required
+@cache.cached(timeout=10, make_cache_key=lambda: f"settings:{settings_stamp()}")
 def api_get_settings():
-    return jsonify(get_settings())
+    return jsonify(get_settings(readonly=True))
 
 @APP.route(f"{ADMIN_ROUTE}/api/settings/save", methods=["POST"])
 @login_required
 def api_save_settings():
     incoming = request.get_json(force=True)
-    settings = get_settings()
-    settings.update(incoming)
-    save_settings(settings)
+    with _settings_locked():
+        settings = get_settings()
+        settings.update(incoming)
+        save_settings(settings)
     return jsonify({"status":"saved","settings":settings})
 
 @APP.route(f"{ADMIN_ROUTE}/api/domain/add", methods=["POST"])
@@ -222,26 +533,28 @@ def api_domain_add():
     domain = (request.get_json(force=True) or {}).get("domain","").strip().lower()
     if not domain:
         return jsonify({"error":"no domain"}),400
-    settings = get_settings()
-    if domain not in settings["trusted_domains"]:
-        settings["trusted_domains"].append(domain)
-        save_settings(settings)
+    with _settings_locked():
+        settings = get_settings()
+        if domain not in settings["trusted_domains"]:
+            settings["trusted_domains"].append(domain)
+            save_settings(settings)
     return jsonify({"status":"added","trusted_domains":settings["trusted_domains"]})
 
 @APP.route(f"{ADMIN_ROUTE}/api/domain/remove", methods=["POST"])
 @login_required
 def api_domain_remove():
     domain = (request.get_json(force=True) or {}).get("domain","").strip().lower()
-    settings = get_settings()
-    if domain in settings["trusted_domains"]:
-        settings["trusted_domains"].remove(domain)
-        save_settings(settings)
+    with _settings_locked():
+        settings = get_settings()
+        if domain in settings["trusted_domains"]:
+            settings["trusted_domains"].remove(domain)
+            save_settings(settings)
     return jsonify({"status":"removed","trusted_domains":settings["trusted_domains"]})
 
 @APP.route(f"{ADMIN_ROUTE}/api/history/clear", methods=["POST"])
 @login_required
 def api_history_clear():
-    save_json(HISTORY_FILE, [])
+    clear_history()
     return jsonify({"status":"cleared"})
 
 @APP.route(f"{ADMIN_ROUTE}/api/retrain", methods=["POST"])
@@ -261,7 +574,7 @@ def api_upload_csv():
     f = request.files["file"]
     fn = secure_filename(f.filename)
     path = os.path.join(UPLOAD_DIR, fn)
-    f.save(path)
+    f.save(path, buffer_size=64 * 1024)  # stream to disk in 64KB chunks
     try:
         train_from_csv(path)
     except Exception as e:
@@ -1,26 +1,28 @@
 # features.py — Advanced URL Feature Extraction for Phishing Detection (Revised)
 import re
+from collections import Counter
+from functools import lru_cache
 from urllib.parse import urlparse
-from datetime import datetime
 import math
-import whois
+import numpy as np
+from whois_cache import get_domain_age
 
 # ===============================
 # TRUSTED DOMAINS / SUSPICIOUS TOKENS
 # ===============================
-TRUSTED_DOMAINS = [
+TRUSTED_DOMAINS = frozenset({
     "openai.com",
     "github.com",
     "python.org",
     "wikipedia.org",
     "example.com"
-]
+})
 
-SUSPICIOUS_TOKENS = [
+SUSPICIOUS_TOKENS = frozenset({
     "login", "verify", "update", "secure", "account", "password",
     "bank", "prize", "reward", "free", "click", "urgent", "confirm",
     "reset", "winner", "claim"
-]
+})
 
 # ===============================
 # FEATURE NAMES
@@ -56,10 +58,13 @@ FEATURE_NAMES = [
 # REGEX PATTERNS
 # ===============================
 ZERO_WIDTH_RE = re.compile(r"[\u200B\u200C\u200D\uFEFF]")
-NON_ASCII_RE = re.compile(r"[^\x00-\x7F]")
 PUNYCODE_RE = re.compile(r"xn--", re.IGNORECASE)
 IP_RE = re.compile(r"^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
 
+# Inputs longer than this (file contents, up to the upload limit) are never
+# used as cache keys, so per-worker caches stay bounded by URL-sized strings
+MEMO_MAX_LEN = 2048
+
 # Optional TLD risk scores
 TLD_RISK_SCORES = {
     "com": 0.1,
@@ -78,8 +83,32 @@ TLD_RISK_SCORES = {
 def shannon_entropy(s: str) -> float:
     if not s:
         return 0.0
-    probs = [s.count(c)/len(s) for c in set(s)]
-    return -sum(p*math.log2(p) for p in probs)
+    # H = log2(n) - sum(c*log2(c))/n, from a single Counter pass over s
+    n = len(s)
+    return math.log2(n) - sum(c*math.log2(c) for c in Counter(s).values())/n
+
+def _parse_url_parts(url: str) -> tuple:
+    parsed = urlparse(url)
+    return parsed.hostname or "", parsed.path or "", parsed.query or ""
+
+_parse_url_parts_cached = lru_cache(maxsize=8192)(_parse_url_parts)
+
+def parse_url_parts(url: str) -> tuple:
+    """Return (hostname, path, query) for a URL, cached for URL-sized inputs since scans repeat them."""
+    return (_parse_url_parts_cached if len(url) <= MEMO_MAX_LEN else _parse_url_parts)(url)
+
+def is_trusted_domain(hostname: str, trusted: frozenset = TRUSTED_DOMAINS) -> bool:
+    """True if hostname or any parent domain is in the (lower-cased) trusted set."""
+    if not hostname:
+        return False
+    # Only suffixes as deep as the deepest trusted entry can match, so split off
+    # just those labels; a full split is quadratic for text with thousands of dots
+    parts = hostname.rsplit('.', _max_labels(trusted))
+    return any('.'.join(parts[i:]) in trusted for i in range(len(parts)))
+
+@lru_cache(maxsize=32)
+def _max_labels(trusted: frozenset) -> int:
+    return max((d.count('.') + 1 for d in trusted), default=0)
 
 def count_subdomains(hostname: str) -> int:
     if not hostname:
@@ -94,63 +123,63 @@ def get_tld_risk(hostname: str) -> float:
     return TLD_RISK_SCORES.get(tld, 0.2)
 
 def get_domain_age_days(hostname: str) -> float:
-    """Return domain age in days. If unavailable, return 0."""
+    """Return domain age in days from the WHOIS cache. If not cached yet, return 0."""
     if not hostname:
         return 0.0
-    try:
-        parts = hostname.split('.')
-        domain = '.'.join(parts[-2:]) if len(parts) > 1 else hostname
-        w = whois.whois(domain)
-        creation_date = w.creation_date
-        if isinstance(creation_date, list):
-            creation_date = creation_date[0]
-        if creation_date:
-            return max((datetime.utcnow() - creation_date).days, 0.0)
-    except:
-        pass
-    return 0.0
+    parts = hostname.split('.')
+    domain = '.'.join(parts[-2:]) if len(parts) > 1 else hostname
+    return get_domain_age(domain.lower())
 
 # ===============================
 # FEATURE EXTRACTION FUNCTION
 # ===============================
 def extract_features_from_url(url: str) -> list:
     """Extract 24 features from URL for phishing detection."""
+    static, hostname = _url_features((url or "").strip())
+    # Domain age comes from the WHOIS cache and can change between calls,
+    # so it is looked up fresh rather than memoized with the rest
+    age = get_domain_age_days(hostname)
+    return [*static, float(age) if age is not None else 0.0]
+
+def _url_features(url: str) -> tuple:
+    """The first 23 features (everything but domain age) and the hostname."""
+    return (_url_features_cached if len(url) <= MEMO_MAX_LEN else _compute_url_features)(url)
+
+def _compute_url_features(url: str) -> tuple:
     features = []
-    url = (url or "").strip()
     features.append(len(url))  # url_length
 
     # Parse URL safely
     try:
-        parsed = urlparse(url)
-        hostname = parsed.hostname or ""
-        path = parsed.path or ""
-        query = parsed.query or ""
+        hostname, path, query = parse_url_parts(url)
         features.extend([len(hostname), len(path), len(query)])
     except:
         hostname, path, query = "", "", ""
         features.extend([0, 0, 0])
 
     # Character counts
-    features.append(sum(c.isdigit() for c in url))  # num_digits
-    features.append(url.count('-'))                  # num_hyphens
-    features.append(url.count('@'))                  # num_at_symbols
-    features.append(url.count('?'))                  # num_question_marks
-    features.append(url.count('='))                  # num_equals
-    features.append(url.count('%'))                  # num_percent
-    features.append(url.count('_'))                  # num_underscores
-    features.append(url.count('.'))                  # num_dots
+    url_lower = url.lower()
+    features.append(sum(map(str.isdigit, url)))  # num_digits
+    features.append(url.count('-'))              # num_hyphens
+    features.append(url.count('@'))              # num_at_symbols
+    features.append(url.count('?'))              # num_question_marks
+    features.append(url.count('='))              # num_equals
+    features.append(url.count('%'))              # num_percent
+    features.append(url.count('_'))              # num_underscores
+    features.append(url.count('.'))              # num_dots
 
     # IP address check
     features.append(1 if IP_RE.match(hostname) else 0)
 
     # Suspicious tokens
-    features.append(sum(1 for t in SUSPICIOUS_TOKENS if t in url.lower()))
+    features.append(sum(t in url_lower for t in SUSPICIOUS_TOKENS))
 
     # HTTPS
-    features.append(1 if url.lower().startswith("https://") else 0)
+    features.append(1 if url_lower.startswith("https://") else 0)
 
     # Non-ASCII & zero-width
-    non_ascii_count = len(NON_ASCII_RE.findall(url))
+    # encoding to ASCII with errors="ignore" drops exactly the non-ASCII chars
+    non_ascii_count = len(url) - len(url.encode("ascii", "ignore"))
     features.append(non_ascii_count)
     features.append(non_ascii_count / max(len(url), 1))
     zero_width_count = len(ZERO_WIDTH_RE.findall(url))
@@ -164,9 +193,23 @@ def extract_features_from_url(url: str) -> list:
     features.append(count_subdomains(hostname))
     features.append(shannon_entropy(hostname))
     features.append(get_tld_risk(hostname))
-    features.append(get_domain_age_days(hostname))
 
     # Ensure all features are numeric
-    features = [float(f) if f is not None else 0.0 for f in features]
-
-    return features
+    return tuple(float(f) if f is not None else 0.0 for f in features), hostname
+
+_url_features_cached = lru_cache(maxsize=16384)(_compute_url_features)
+
+def extract_features_batch(urls, domain_ages=None) -> np.ndarray:
+    """
+    Extract features for many URLs into one (N, len(FEATURE_NAMES)) matrix.
+    If domain_ages is given it fills the last column instead of WHOIS lookups.
+    """
+    X = np.empty((len(urls), len(FEATURE_NAMES)), dtype=np.float32)
+    if domain_ages is None:
+        for i, url in enumerate(urls):
+            X[i] = extract_features_from_url(url)
+    else:
+        for i, url in enumerate(urls):
+            X[i, :-1] = _url_features((url or "").strip())[0]
+        X[:, -1] = domain_ages
+    return X
@@ -4,6 +4,16 @@ import re
 from io import BytesIO
 from bs4 import BeautifulSoup
 
+try:
+    import fitz  # PyMuPDF: optional, much faster PDF text extraction
+except Exception:
+    fitz = None
+
+try:
+    from lxml import html as lxml_html  # C parser for HTML uploads
+except Exception:
+    lxml_html = None
+
 try:
     from PyPDF2 import PdfReader
 except Exception:
@@ -16,39 +26,58 @@ except Exception:
 
 ALLOWED_EXT = {".pdf", ".docx", ".txt", ".html", ".htm", ".eml"}
 
+URL_RE = re.compile(r"https?://[^\s)'\"]+")
+
 
 def allowed_file(filename: str) -> bool:
     ext = os.path.splitext(filename)[1].lower()
     return ext in ALLOWED_EXT
 
 
+def extract_pdf_text(file_bytes: bytes) -> str:
+    if fitz is not None:
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            return "\n".join(page.get_text("text") for page in doc)
+    reader = PdfReader(BytesIO(file_bytes))
+    parts = []
+    for page in reader.pages:
+        try:
+            parts.append(page.extract_text() or "")
+        except Exception:
+            continue
+    return "".join(parts)
+
+
+def extract_html_text_and_links(file_bytes: bytes):
+    if lxml_html is not None:
+        tree = lxml_html.fromstring(file_bytes)
+        text = "\n".join(tree.xpath("//text()[not(ancestor::script) and not(ancestor::style)]"))
+        urls = [href for href in tree.xpath("//a/@href") if href.startswith("http")]
+        return text, urls
+    soup = BeautifulSoup(file_bytes, "html.parser")
+    text = soup.get_text(separator="\n")
+    urls = [a["href"] for a in soup.find_all("a", href=True) if a["href"].startswith("http")]
+    return text, urls
+
+
 def extract_text_and_links(file_bytes: bytes, filename: str):
     text = ""
     urls = []
     ext = os.path.splitext(filename)[1].lower()
     try:
-        if ext == ".pdf" and PdfReader is not None:
-            reader = PdfReader(BytesIO(file_bytes))
-            for page in reader.pages:
-                try:
-                    text += page.extract_text() or ""
-                except Exception:
-                    continue
-            urls = re.findall(r"https?://[^\s)'\"]+", text)
+        if ext == ".pdf" and (fitz is not None or PdfReader is not None):
+            text = extract_pdf_text(file_bytes)
+            urls = URL_RE.findall(text)
         elif ext == ".docx" and Document is not None:
             doc = Document(BytesIO(file_bytes))
             text = "\n".join([p.text for p in doc.paragraphs])
-            urls = re.findall(r"https?://[^\s)'\"]+", text)
+            urls = URL_RE.findall(text)
         elif ext in (".html", ".htm"):
-            soup = BeautifulSoup(file_bytes, "html.parser")
-            text = soup.get_text(separator="\n")
-            urls = [a["href"] for a in soup.find_all("a", href=True) if a["href"].startswith("http")]
-        elif ext == ".txt" or ext == ".eml":
-            text = file_bytes.decode("utf-8", errors="ignore")
-            urls = re.findall(r"https?://[^\s)'\"]+", text)
+            text, urls = extract_html_text_and_links(file_bytes)
         else:
+            # .txt, .eml and anything else: plain text
             text = file_bytes.decode("utf-8", errors="ignore")
-            urls = re.findall(r"https?://[^\s)'\"]+", text)
+            urls = URL_RE.findall(text)
     except Exception:
         pass
 
@@ -57,14 +86,15 @@ def extract_text_and_links(file_bytes: bytes, filename: str):
 
 
 def scan_file(file_bytes: bytes, filename: str, settings: dict = None, threshold: float = None):
-    from predictor import detect_phishing
+    from predictor import detect_phishing_batch
     text, urls = extract_text_and_links(file_bytes, filename)
+    # detect_* accept either a numeric threshold or the settings dict
+    threshold = threshold if threshold is not None else settings
     results = []
     if urls:
-        for u in urls:
-            results.append(detect_phishing(u, settings=settings, threshold=threshold))
+        results = detect_phishing_batch(urls, threshold)
     elif text:
-        results.append(detect_phishing(text[:4000], settings=settings, threshold=threshold))
+        results = detect_phishing_batch([text[:4000]], threshold)
     suspicious = [r for r in results if r.get("verdict") == "phishing"]
     return {
         "filename": filename,
@@ -0,0 +1,25 @@
+# ============================================================
+# gunicorn_conf.py — Production server config for PhisGuard
+# Usage: gunicorn -c gunicorn_conf.py wsgi:application
+# ============================================================
+
+import multiprocessing
+
+bind = "0.0.0.0:8080"
+
+# One process per core carries the CPU-bound scoring (feature extraction
+# and model inference); more processes would only share the same cores.
+workers = multiprocessing.cpu_count()
+
+# Threads add concurrency, not CPU: they share their worker's GIL, so they
+# mainly let a long retrain, an NDJSON stream or a slow client run alongside
+# cheap history/settings reads. Shared state in the app is lock-guarded.
+worker_class = "gthread"
+threads = 4
+
+# Import app.py (and load the ensemble model) once in the master so the
+# workers share those pages copy-on-write instead of each loading a copy.
+preload_app = True
+
+# Model (re)training runs inside admin requests and can take a while.
+timeout = 300
@@ -1,7 +1,7 @@
 # predictor.py — Hybrid Phishing Detector (Revised, Safe Threshold Handling, CSV Training)
-import os, re, logging, numpy as np, pandas as pd
+import os, re, csv, time, logging, threading, numpy as np
+from collections import Counter, OrderedDict
 from datetime import datetime
-from urllib.parse import urlparse
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
@@ -9,78 +9,211 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier, VotingClassifier
 from sklearn.naive_bayes import GaussianNB
 from sklearn.utils import shuffle
-import xgboost as xgb
-from catboost import CatBoostClassifier
-import lightgbm as lgb
-from features import extract_features_from_url, FEATURE_NAMES, TRUSTED_DOMAINS, SUSPICIOUS_TOKENS
+from features import (
+    extract_features_batch, parse_url_parts, is_trusted_domain,
+    FEATURE_NAMES, TRUSTED_DOMAINS, SUSPICIOUS_TOKENS, MEMO_MAX_LEN,
+    PUNYCODE_RE, IP_RE,
+)
 
 logging.basicConfig(level=logging.INFO, format='[predictor] %(message)s')
 
 DEFAULT_ML_WEIGHT = 0.6
 DEFAULT_THRESHOLD = 0.55
 
-ZERO_WIDTH_RE = re.compile(r"[\u200B\u200C\u200D\uFEFF]")
-NON_ASCII_RE = re.compile(r"[^\x00-\x7F]")
-PUNYCODE_RE = re.compile(r"xn--", re.IGNORECASE)
-IP_RE = re.compile(r"^\d{1,3}(\.\d{1,3}){3}$")
+ENSEMBLE_WEIGHTS = [1, 1, 0.5, 2, 2.5, 2]  # lr, rf, nb, xgb, cb, lgb
+
+URL_PREFIX_RE = re.compile(r"^(?:https?://|www\.)")
+
+# frozenset order follows per-process string hashing; fix it so every worker
+# lists matched terms identically (most_common keeps ties in this order)
+SUSPICIOUS_TERM_ORDER = tuple(sorted(SUSPICIOUS_TOKENS))
+
+RESULT_CACHE_SIZE = 4096
+RESULT_CACHE_TTL = 300  # seconds; lets freshly fetched WHOIS ages reach re-scans
 
 MODEL_DIR = "models"
 os.makedirs(MODEL_DIR, exist_ok=True)
 MODEL_PATH = os.path.join(MODEL_DIR, "ensemble_model.joblib")
 
+# ------------------------------
+# Synthetic Training Data
+# ------------------------------
+SYNTHETIC_TLDS = ["xyz", "top", "club", "info", "online", "com", "net"]
+SYNTHETIC_CHARS = np.array(list("abcdefghijklmnopqrstuvwxyz0123456789"))
+
+def generate_synthetic_dataset(n=3000, seed=1):
+    """Labelled synthetic URLs (1 = phishing) for bootstrapping the ensemble."""
+    rng = np.random.default_rng(seed)
+    tokens = sorted(SUSPICIOUS_TOKENS)
+    benign = sorted(TRUSTED_DOMAINS)
+
+    # Draw every random choice up front, one array per field
+    y = (rng.random(n) < 0.5).astype(np.int8)
+    tok_a = rng.integers(0, len(tokens), n)
+    tok_b = rng.integers(0, len(tokens), n)
+    hosts = rng.integers(0, len(benign), n)
+    tlds = rng.integers(0, len(SYNTHETIC_TLDS), n)
+    nums = rng.integers(1, 999, n)
+    use_ip = rng.random(n) < 0.15
+    octets = rng.integers(1, 255, (n, 4))
+    path_lens = rng.integers(4, 20, n)
+    paths = SYNTHETIC_CHARS[rng.integers(0, len(SYNTHETIC_CHARS), (n, 20))]
+
+    urls = []
+    for i in range(n):
+        path = "".join(paths[i, :path_lens[i]])
+        if not y[i]:
+            urls.append(f"https://www.{benign[hosts[i]]}/{path}")
+        elif use_ip[i]:
+            urls.append(f"http://{'.'.join(map(str, octets[i]))}/{tokens[tok_a[i]]}/{path}")
+        else:
+            urls.append(f"http://{tokens[tok_a[i]]}-{tokens[tok_b[i]]}{nums[i]}.{SYNTHETIC_TLDS[tlds[i]]}/{path}?id={nums[i]}")
+
+    # Made-up hosts have no WHOIS record; draw ages instead of queueing lookups
+    ages = np.where(y == 1, rng.integers(0, 90, n), rng.integers(1000, 9000, n))
+    return extract_features_batch(urls, domain_ages=ages), y
+
 # ------------------------------
 # ML Predictor
 # ------------------------------
 class MLPredictor:
     def __init__(self, model_path=MODEL_PATH):
         self.model_path = model_path
+        self._stamp = None  # model file stamp the loaded model came from
+        self._reload_lock = threading.Lock()
         self.model = self._load_or_train()
 
     def _build_estimators(self):
+        # Boosting libraries are only needed to build and fit; joblib.load
+        # imports whatever the pickled model references on its own
+        import xgboost as xgb
+        import lightgbm as lgb
+        from catboost import CatBoostClassifier
         return {
             "lr": make_pipeline(StandardScaler(), LogisticRegression(max_iter=2000)),
             "rf": RandomForestClassifier(n_estimators=300, n_jobs=-1, class_weight="balanced_subsample", random_state=1),
             "nb": make_pipeline(StandardScaler(), GaussianNB()),
-            "xgb": xgb.XGBClassifier(use_label_encoder=False, eval_metric="logloss", n_estimators=400, learning_rate=0.05, max_depth=6, n_jobs=-1, random_state=1),
+            "xgb": xgb.XGBClassifier(use_label_encoder=False, eval_metric="logloss", tree_method="hist", n_estimators=400, learning_rate=0.05, max_depth=6, n_jobs=-1, random_state=1),
             "cb": CatBoostClassifier(iterations=400, learning_rate=0.05, depth=8, loss_function="Logloss", verbose=0, random_seed=1),
             "lgb": lgb.LGBMClassifier(n_estimators=400, learning_rate=0.05, max_depth=7, num_leaves=31, min_child_samples=5, class_weight="balanced", n_jobs=-1, verbose=-1)
         }
 
     def _train_model(self, samples=3000):
-        from predictor import generate_synthetic_dataset
         X, y = generate_synthetic_dataset(samples)
         X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, stratify=y, random_state=1)
-        estimators = self._build_estimators()
-        fitted = [(name, model.fit(X_train, y_train)) for name, model in estimators.items()]
-        weights = [1, 1, 0.5, 2, 2.5, 2]
-        ensemble = VotingClassifier(estimators=fitted, voting="soft", weights=weights, n_jobs=-1)
-        ensemble.fit(X_train, y_train)
-        import joblib
-        joblib.dump(ensemble, self.model_path)
+        ensemble = self._fit_ensemble(X_train, y_train)
         logging.info(f"✅ ML Model trained and saved to {self.model_path}")
         return ensemble
 
+    def _fit_ensemble(self, X_train, y_train):
+        """Fit the soft-voting ensemble and persist it to model_path."""
+        import joblib
+        # VotingClassifier clones and fits each estimator itself; no need to pre-fit them
+        ensemble = VotingClassifier(
+            estimators=list(self._build_estimators().items()),
+            voting="soft", weights=ENSEMBLE_WEIGHTS, n_jobs=-1,
+        )
+        ensemble.fit(X_train, y_train)
+        # Uncompressed so loads skip decompression; written aside and swapped in so
+        # workers reloading it never read a half-written file
+        tmp_path = f"{self.model_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        joblib.dump(ensemble, tmp_path, compress=0)
+        os.replace(tmp_path, self.model_path)
+        self._stamp = self._model_stamp()
+        return self._for_inference(ensemble)
+
+    def _model_stamp(self):
+        try:
+            st = os.stat(self.model_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _for_inference(self, model):
+        """
+        Scoring is one small batch per request and gunicorn already runs a
+        worker per core, so per-estimator thread pools only add overhead.
+        """
+        for est in [model, *getattr(model, "estimators_", [])]:
+            if hasattr(est, "n_jobs"):
+                est.n_jobs = 1
+            if hasattr(est, "get_booster"):
+                # XGBoost predicts with the booster's nthread, which n_jobs doesn't reach
+                est.get_booster().set_param({"nthread": 1})
+        # Precompute the soft-voting forward pass so scoring walks the fitted
+        # estimators once instead of going through VotingClassifier as well.
+        # A fitted CatBoost model rejects set_params, so it gets thread_count per call.
+        fitted = [
+            (name, est, {"thread_count": 1} if hasattr(est, "get_all_params") else {})
+            for name, est in getattr(model, "named_estimators_", {}).items() if est != "drop"
+        ]
+        weights = getattr(model, "weights", None)
+        weights = np.ones(len(fitted)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self._forward = (fitted, weights / weights.sum()) if fitted else None
+        return model
+
     def _load_or_train(self):
         import joblib
         if os.path.exists(self.model_path):
             try:
+                stamp = self._model_stamp()
                 model = joblib.load(self.model_path)
-                _ = model.predict_proba(np.zeros((1, len(FEATURE_NAMES))))
+                _ = model.predict_proba(np.zeros((1, len(FEATURE_NAMES)), dtype=np.float32))
                 logging.info("✅ ML Model loaded from disk")
-                return model
+                self._stamp = stamp
+                return self._for_inference(model)
+            except OSError as e:
+                # Couldn't read the file (fd limit, permissions, ...): that says nothing
+                # about the model itself, so never retrain over it
+                logging.error(f"❌ Could not read ML Model {self.model_path}: {e}")
+                raise
             except:
                 logging.warning("⚠️ ML Model corrupted, retraining...")
         return self._train_model()
 
+    def refresh(self):
+        """Reload the model if another worker retrained it. True if it changed."""
+        import joblib
+        stamp = self._model_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        with self._reload_lock:
+            if stamp == self._stamp:
+                return False
+            try:
+                model = joblib.load(self.model_path)
+            except OSError as e:
+                # Transient read failure: keep the old stamp so the next request retries
+                logging.warning(f"⚠️ Could not read updated ML Model, will retry: {e}")
+                return False
+            except Exception as e:
+                logging.warning(f"⚠️ Updated ML Model is unreadable, keeping the current one: {e}")
+                self._stamp = stamp  # don't re-unpickle the same bad file on every request
+                return False
+            self.model = self._for_inference(model)
+            self._stamp = stamp
+            logging.info("✅ ML Model reloaded after retrain")
+            return True
+
     def predict_proba(self, features):
-        avg = float(self.model.predict_proba(features.reshape(1, -1))[0, 1])
-        per_model = {}
-        if hasattr(self.model, "named_estimators_"):
-            for name, est in self.model.named_estimators_.items():
-                try:
-                    per_model[name] = float(est.predict_proba(features.reshape(1, -1))[0, 1])
-                except:
-                    per_model[name] = 0.0
+        avg, per_model = self.predict_proba_batch(np.asarray(features).reshape(1, -1))
+        return float(avg[0]), per_model[0]
+
+    def predict_proba_batch(self, X):
+        """Score a (B, F) matrix with one predict_proba call per estimator."""
+        # Lay out the batch once; every estimator below reads this same buffer.
+        # float32 is what the tree models compare against internally anyway.
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        forward = getattr(self, "_forward", None)
+        if forward is None:
+            return self.model.predict_proba(X)[:, 1], [{} for _ in range(len(X))]
+        fitted, weights = forward
+        probs = np.empty((len(fitted), len(X)))
+        for i, (_, est, kwargs) in enumerate(fitted):
+            probs[i] = est.predict_proba(X, **kwargs)[:, 1]
+        avg = weights @ probs
+        names = [name for name, _, _ in fitted]
+        per_model = [dict(zip(names, col)) for col in probs.T.tolist()]
         return avg, per_model
 
     def retrain(self, samples=3000):
@@ -95,26 +228,56 @@ ml_predictor = MLPredictor()
 class PhishingDetector:
     def __init__(self, ml_predictor, trusted_domains=None, ml_weight=DEFAULT_ML_WEIGHT):
         self.ml = ml_predictor
-        self.trusted_domains = trusted_domains or TRUSTED_DOMAINS
+        self.trusted_domains = frozenset(d.lower() for d in trusted_domains) if trusted_domains else TRUSTED_DOMAINS
         self.ml_weight = ml_weight
+        self._results = OrderedDict()  # (text, threshold) -> (monotonic time, result)
+        self._results_lock = threading.Lock()
+
+    def clear_cache(self):
+        with self._results_lock:
+            self._results.clear()
+
+    def _cache_get(self, key):
+        if len(key[0]) > MEMO_MAX_LEN:
+            return None
+        with self._results_lock:
+            hit = self._results.get(key)
+            if hit is None:
+                return None
+            if time.monotonic() - hit[0] > RESULT_CACHE_TTL:
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+            return hit[1]
+
+    def _cache_put(self, key, result):
+        if len(key[0]) > MEMO_MAX_LEN:
+            return  # file contents: keying on them would pin megabytes per entry
+        with self._results_lock:
+            self._results[key] = (time.monotonic(), result)
+            self._results.move_to_end(key)
+            while len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
 
     def _heuristic_score(self, text, domain):
         heur_score = 0.0
         reasons = []
 
-        trusted_found = any(domain.endswith(td) for td in self.trusted_domains if td)
+        trusted_found = is_trusted_domain(domain, self.trusted_domains)
         if trusted_found: reasons.append("✅ Domain is trusted")
 
-        token_counts = [text.lower().count(t) for t in SUSPICIOUS_TOKENS if t in text.lower()]
-        if token_counts:
-            score = min(0.95, 0.2 + 0.1*np.log1p(sum(token_counts)))
+        text_lower = text.lower()
+        # str.count per token beats a regex/automaton pass at URL lengths
+        terms = Counter({t: n for t in SUSPICIOUS_TERM_ORDER if (n := text_lower.count(t))})
+        token_total = sum(terms.values())
+        if token_total:
+            score = min(0.95, 0.2 + 0.1*np.log1p(token_total))
             heur_score = max(heur_score, score)
-            reasons.append(f"⚠️ Suspicious terms detected ({sum(token_counts)})")
+            named = ", ".join(t for t, _ in terms.most_common())
+            reasons.append(f"⚠️ Suspicious terms detected ({token_total}): {named}")
 
-        non_ascii = len(NON_ASCII_RE.findall(text))
-        zero_width = len(ZERO_WIDTH_RE.findall(text))
-        punycode = 1 if PUNYCODE_RE.search(domain) else 0
-        if non_ascii > 0 or zero_width > 0 or punycode:
+        # Zero-width characters are non-ASCII too, so one isascii() covers both
+        if not text.isascii() or PUNYCODE_RE.search(domain):
             heur_score = max(heur_score, 0.6)
             reasons.append("⚠️ Unicode/obfuscation detected")
 
@@ -127,37 +290,38 @@ class PhishingDetector:
             heur_score = max(heur_score, 0.5)
             reasons.append(f"⚠️ Subdomain depth suspicious ({depth})")
 
-        path_entropy = len(set(text)) / (len(text)+1)
+        chars = Counter(text)  # one pass for distinct characters and the '-'/'_' counts
+        path_entropy = len(chars) / (len(text)+1)
         if path_entropy > 0.65: 
             heur_score = max(heur_score, 0.55)
             reasons.append("⚠️ High URL entropy (path/query)")
 
         if "@" in text: heur_score = max(heur_score,0.75); reasons.append("⚠️ Contains '@'")
-        if text.count('-') > 3 or text.count('_') > 3: heur_score = max(heur_score,0.5); reasons.append("⚠️ Many special characters")
+        if chars['-'] > 3 or chars['_'] > 3: heur_score = max(heur_score,0.5); reasons.append("⚠️ Many special characters")
         if len(text) > 75: heur_score = max(heur_score,0.55); reasons.append("⚠️ URL unusually long")
 
         return min(1.0, heur_score), reasons, trusted_found
 
-    def detect(self, input_text, threshold=None):
+    def _resolve_threshold(self, threshold):
         if isinstance(threshold, dict):
             threshold = threshold.get("threshold", DEFAULT_THRESHOLD)
         try:
-            threshold_use = float(threshold)
+            return float(threshold)
         except:
-            threshold_use = DEFAULT_THRESHOLD
+            return DEFAULT_THRESHOLD
 
+    def _prepare(self, input_text):
         text = input_text.strip()
-        is_url = re.match(r"^(https?:\/\/|www\.)", text) or "." in text
-        feats = np.array(extract_features_from_url(text if is_url else "textinput.local"), dtype=float)
+        is_url = URL_PREFIX_RE.match(text) or "." in text
 
         domain = ""
         try:
-            parsed = urlparse(text if is_url else "")
-            domain = (parsed.hostname or "").lower() if parsed.hostname else ""
+            domain = parse_url_parts(text if is_url else "")[0].lower()
         except:
             domain = ""
+        return text, is_url, domain
 
-        ml_prob, per_model = self.ml.predict_proba(feats)
+    def _build_result(self, text, is_url, domain, ml_prob, per_model, threshold_use):
         heur_score, heur_reasons, trusted_found = self._heuristic_score(text, domain)
 
         ml_weight = self.ml_weight
@@ -174,8 +338,8 @@ class PhishingDetector:
             "domain": domain or "(file content)" if not is_url else domain,
             "type": "url" if is_url else "file",
             "ml_probability": round(ml_prob,4),
-            "heuristic_score": round(heur_score,4),
-            "final_score": round(final_score,4),
+            "heuristic_score": round(float(heur_score),4),
+            "final_score": round(float(final_score),4),
             "verdict": verdict,
             "threshold": threshold_use,
             "trusted": trusted_found,
@@ -184,6 +348,43 @@ class PhishingDetector:
             "per_model": per_model
         }
 
+    def detect(self, input_text, threshold=None):
+        return self.detect_batch([input_text], threshold)[0]
+
+    def detect_batch(self, inputs, threshold=None):
+        """Score several inputs with a single model pass; one result dict per input."""
+        # Another worker may have retrained; its cached results are stale too
+        if self.ml.refresh():
+            self.clear_cache()
+        threshold_use = self._resolve_threshold(threshold)
+        prepared = [self._prepare(t) for t in inputs]
+        results = [self._cache_get((text, threshold_use)) for text, _, _ in prepared]
+
+        # Only inputs not scored recently go through feature extraction and the
+        # ensemble, and repeats within the batch (e.g. a file that is the URL) once
+        misses = {}  # text -> indices of every input that prepared to it
+        for i, r in enumerate(results):
+            if r is None:
+                misses.setdefault(prepared[i][0], []).append(i)
+        if misses:
+            firsts = [prepared[idxs[0]] for idxs in misses.values()]
+            X = extract_features_batch([
+                text if is_url else "textinput.local" for text, is_url, _ in firsts
+            ])
+            ml_probs, per_models = self.ml.predict_proba_batch(X)
+            for idxs, (text, is_url, domain), p, per_model in zip(misses.values(), firsts, ml_probs, per_models):
+                r = self._build_result(text, is_url, domain, float(p), per_model, threshold_use)
+                self._cache_put((text, threshold_use), r)
+                for i in idxs:
+                    results[i] = r
+
+        # Callers annotate results in place, so hand out copies with a fresh timestamp
+        now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        return [
+            dict(r, reasons=list(r["reasons"]), per_model=dict(r["per_model"]), timestamp=now)
+            for r in results
+        ]
+
 detector = PhishingDetector(ml_predictor)
 
 # ------------------------------
@@ -192,8 +393,13 @@ detector = PhishingDetector(ml_predictor)
 def detect_phishing(url, threshold=None):
     return detector.detect(url, threshold)
 
+def detect_phishing_batch(urls, threshold=None):
+    return detector.detect_batch(urls, threshold)
+
 def retrain_model(samples=3000):
-    return ml_predictor.retrain(samples)
+    ok = ml_predictor.retrain(samples)
+    detector.clear_cache()
+    return ok
 
 # ------------------------------
 # Train from CSV
@@ -203,30 +409,31 @@ def train_from_csv(csv_path, target_col="label"):
     Train the ML ensemble from a CSV file.
     Assumes features columns match FEATURE_NAMES and target_col is the label.
     """
-    import joblib
-
     if not os.path.exists(csv_path):
         logging.error(f"CSV file not found: {csv_path}")
         return False
 
-    df = pd.read_csv(csv_path)
-    if target_col not in df.columns:
+    # Validate the header before parsing any rows
+    with open(csv_path, newline="", encoding="utf-8-sig", errors="ignore") as f:
+        header = next(csv.reader(f), [])
+    if target_col not in header:
         logging.error(f"Target column '{target_col}' not in CSV")
         return False
 
-    X = df[FEATURE_NAMES].values
-    y = df[target_col].values
+    # Parse only the columns we train on, features straight to float32
+    import pandas as pd  # training-only; the scan path never needs it
+    df = pd.read_csv(
+        csv_path,
+        usecols=FEATURE_NAMES + [target_col],
+        dtype={name: np.float32 for name in FEATURE_NAMES},
+    )
+    X = df[FEATURE_NAMES].to_numpy()
+    y = df[target_col].to_numpy()
+    del df
     X, y = shuffle(X, y, random_state=1)
 
     X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, stratify=y, random_state=1)
-    estimators = ml_predictor._build_estimators()
-    fitted = [(name, model.fit(X_train, y_train)) for name, model in estimators.items()]
-    weights = [1, 1, 0.5, 2, 2.5, 2]
-
-    ensemble = VotingClassifier(estimators=fitted, voting="soft", weights=weights, n_jobs=-1)
-    ensemble.fit(X_train, y_train)
-    joblib.dump(ensemble, MODEL_PATH)
-
-    ml_predictor.model = ensemble
+    ml_predictor.model = ml_predictor._fit_ensemble(X_train, y_train)
+    detector.clear_cache()
     logging.info(f"✅ ML Model trained from CSV and saved to {MODEL_PATH}")
     return True
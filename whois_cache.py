@@ -0,0 +1,111 @@
+# whois_cache.py — SQLite-backed WHOIS domain-age cache with background refresh
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+import whois
+
+DATA_DIR = "data"
+CACHE_DB = os.path.join(DATA_DIR, "whois_cache.db")
+TTL_SECONDS = 7 * 24 * 60 * 60  # 7 days
+
+QUEUE_MAX = 256  # lookups run serially; beyond this, new domains wait for a later scan
+
+_queue = queue.Queue(maxsize=QUEUE_MAX)
+_pending = set()
+_pending_lock = threading.Lock()
+_worker = None
+_local = threading.local()
+
+
+def _connect():
+    """
+    This thread's connection, opened (and the table created) on first use.
+    Keyed by pid too: a connection inherited across a gunicorn fork isn't safe to reuse.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB, timeout=5)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS whois_cache "
+        "(domain TEXT PRIMARY KEY, age_days REAL, ts REAL)"
+    )
+    _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+def lookup_domain_age(domain: str) -> float:
+    """Blocking WHOIS lookup. Returns age in days, or 0 if unavailable."""
+    try:
+        w = whois.whois(domain)
+        creation_date = w.creation_date
+        if isinstance(creation_date, list):
+            creation_date = creation_date[0]
+        if creation_date:
+            return float(max((datetime.utcnow() - creation_date).days, 0))
+    except Exception:
+        pass
+    return 0.0
+
+
+def _store(domain: str, age_days: float):
+    conn = _connect()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO whois_cache (domain, age_days, ts) VALUES (?, ?, ?)",
+            (domain, age_days, time.time()),
+        )
+
+
+def _run_worker():
+    while True:
+        domain = _queue.get()
+        try:
+            _store(domain, lookup_domain_age(domain))
+        except Exception as e:
+            logging.warning(f"WHOIS refresh failed for {domain}: {e}")
+        finally:
+            with _pending_lock:
+                _pending.discard(domain)
+            _queue.task_done()
+
+
+def _schedule(domain: str):
+    global _worker
+    with _pending_lock:
+        if domain in _pending:
+            return
+        _pending.add(domain)
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name="whois-refresh", daemon=True)
+            _worker.start()
+    try:
+        _queue.put_nowait(domain)
+    except queue.Full:
+        with _pending_lock:
+            _pending.discard(domain)  # let a later scan queue it again
+
+
+def get_domain_age(domain: str) -> float:
+    """
+    Return the cached domain age in days without touching the network.
+    A stale entry is still returned while a background WHOIS refresh is queued;
+    only a domain never looked up returns 0.
+    """
+    if not domain:
+        return 0.0
+    try:
+        row = _connect().execute(
+            "SELECT age_days, ts FROM whois_cache WHERE domain=?", (domain,)
+        ).fetchone()
+    except sqlite3.Error:
+        row = None
+    if row is None or row[1] < time.time() - TTL_SECONDS:
+        _schedule(domain)
+    return row[0] if row is not None else 0.0